@@ -5,20 +5,30 @@ Invoice OCR Processing Service - Multi-Provider (Gemini & Grok)
 from dotenv import load_dotenv
 load_dotenv()
 
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from typing import List, Optional, Dict, Any
+from fastapi import FastAPI, Request, UploadFile, File, Form, Header, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import List, Optional, Dict, Any, Set, Tuple, AsyncIterator, Callable
 from pydantic import BaseModel, Field
 import tempfile
 import os
+import sys
 from pathlib import Path
 import asyncio
 import json
-from contextlib import asynccontextmanager
+import math
+from collections import deque
+from difflib import SequenceMatcher
+from contextlib import asynccontextmanager, contextmanager
 import google.generativeai as genai
 from openai import OpenAI
+import httpx
 import base64
+import hmac
 from PIL import Image
 import time
+import uuid
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
 
 try:
     from pdf2image import convert_from_path
@@ -27,6 +37,30 @@ except Exception:
     convert_from_path = None
     PDF_SUPPORT = False
 
+try:
+    import preprocess
+    PREPROCESS_SUPPORT = True
+except Exception:
+    preprocess = None
+    PREPROCESS_SUPPORT = False
+
+try:
+    from opentelemetry import trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    TRACING_SUPPORT = True
+except Exception:
+    trace = None
+    TRACING_SUPPORT = False
+
+try:
+    from pyinstrument import Profiler
+    PROFILING_SUPPORT = True
+except Exception:
+    Profiler = None
+    PROFILING_SUPPORT = False
+
 
 class LineItem(BaseModel):
     item_name: str
@@ -56,15 +90,218 @@ class InvoiceResponse(BaseModel):
     
     processing_time_seconds: Optional[float] = None
 
+    # Per-page outcome; "partial" is set when any page is not "ok"
+    partial: bool = False
+    pages: List["PageStatus"] = Field(default_factory=list)
+    retry_pages: List[int] = Field(default_factory=list)
+
+
+class PreprocessingStats(BaseModel):
+    seconds: float
+    rotated_degrees: int = 0
+    skew_degrees: float = 0.0
+    cropped: bool = False
+    binarized: bool = False
+    orientation_uncertain: bool = False  # Sideways page left as-is: 90 vs 270 degrees unclear
+    input_bytes: int
+    output_bytes: int
+
+
+class PageStatus(BaseModel):
+    page_index: int
+    status: str  # "ok", "timeout", "failed" or "skipped"
+    elapsed_seconds: Optional[float] = None
+    error: Optional[str] = None
+    reextractions: int = 0
+    preprocessing: Optional[PreprocessingStats] = None
+    issues: List[str] = Field(default_factory=list)  # Validation problems left after re-extraction
+
+
+InvoiceResponse.model_rebuild()
+
+# Request deadline (seconds); X-Request-Timeout can set it per request, up to the max
+DEFAULT_REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT_SECONDS", "25"))
+MAX_REQUEST_TIMEOUT = float(os.getenv("MAX_REQUEST_TIMEOUT_SECONDS", "120"))
+
+# Same for /api/v1/process-invoices, which takes whole batches of invoices
+DEFAULT_BATCH_REQUEST_TIMEOUT = float(os.getenv("BATCH_REQUEST_TIMEOUT_SECONDS", "600"))
+MAX_BATCH_REQUEST_TIMEOUT = float(os.getenv("MAX_BATCH_REQUEST_TIMEOUT_SECONDS", "1800"))
+
+# Document splitting: minimum header similarity for a page to continue the current invoice
+SPLIT_HEADER_SIMILARITY = float(os.getenv("SPLIT_HEADER_SIMILARITY", "0.6"))
+
+# Page cleanup before extraction (needs numpy): auto-rotate, deskew, crop margins, optionally binarize
+PREPROCESS_ENABLED = os.getenv("PREPROCESS_ENABLED", "true").lower() == "true"
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", str(max((os.cpu_count() or 2) - 1, 1))))
+# The cleanup settings (PREPROCESS_BINARIZE etc.) are read in preprocess.py, which the workers import
+
+# Validation: pages failing arithmetic/required-field checks are re-extracted within this budget
+REQUIRED_FIELDS = [f.strip() for f in os.getenv("REQUIRED_FIELDS", "invoice_number,invoice_date,total_amount").split(",") if f.strip()]
+VALIDATION_TOLERANCE = float(os.getenv("VALIDATION_TOLERANCE", "0.01"))
+REEXTRACT_MAX_PAGES = int(os.getenv("REEXTRACT_MAX_PAGES", "3"))
+REEXTRACT_ATTEMPTS = int(os.getenv("REEXTRACT_ATTEMPTS", "2"))
+REEXTRACT_DPI = int(os.getenv("REEXTRACT_DPI", "450"))
+# Re-extractions get their own slots so they don't queue behind a batch's first pass
+REEXTRACT_CONCURRENCY = int(os.getenv("REEXTRACT_CONCURRENCY", "2"))
+
+# Load limits; /ready reports 503 once MAX_QUEUE_DEPTH pages are waiting
+MAX_CONCURRENT_PAGES = int(os.getenv("MAX_CONCURRENT_PAGES", "8"))
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", "32"))
+# Pages one request may have dispatched at once, so a single batch can't fill the queue
+MAX_PAGES_PER_REQUEST = int(os.getenv("MAX_PAGES_PER_REQUEST", "8"))
+PROVIDER_STATS_WINDOW = int(os.getenv("PROVIDER_STATS_WINDOW", "100"))
+
+# Connection warm-up, Groq only (PROVIDER_BASE_URL overrides the Groq URL, e.g. for a local stand-in)
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "4"))
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT_SECONDS", "5"))
+GROQ_BASE_URL = "https://api.groq.com/openai/v1"
+
+# Tracing exports spans as JSON lines to TRACE_EXPORT_FILE (or stdout when unset)
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE")
+
+# X-Profile: 1 is only honoured with a matching X-Admin-Token; disabled when ADMIN_TOKEN is unset
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+if ADMIN_TOKEN and "your_" in ADMIN_TOKEN.lower():
+    ADMIN_TOKEN = None
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "invoice-ocr-profiles"))
+# Only the newest reports are kept in PROFILE_DIR
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+
 # Global model instances
 gemini_model = None
 groq_client = None
+http_client = None
+preprocess_pool = None
+tracer = None
+trace_export_stream = None
 ocr_mode = None
+fallback_mode = None
+
+# Load tracking
+page_semaphore = asyncio.Semaphore(MAX_CONCURRENT_PAGES)
+reextract_semaphore = asyncio.Semaphore(REEXTRACT_CONCURRENCY)
+pages_in_flight = 0
+pages_queued = 0
+provider_calls = deque(maxlen=PROVIDER_STATS_WINDOW)  # (latency_seconds, ok)
+abandoned_calls: Set[asyncio.Task] = set()  # Provider calls still running after their request gave up
+warmed_up = False
+
+
+def groq_base_url() -> str:
+    # A Groq fallback behind Gemini always talks to the real API
+    if ocr_mode != "groq":
+        return GROQ_BASE_URL
+    return os.getenv("PROVIDER_BASE_URL", GROQ_BASE_URL).rstrip("/")
+
+
+def provider_connected(mode: Optional[str]) -> bool:
+    if mode == "groq":
+        return groq_client is not None
+    if mode == "gemini":
+        return gemini_model is not None
+    return False
+
+
+async def warm_up_connections(base_url: str, count: int) -> int:
+    """Open `count` pooled connections to the provider so the first requests skip DNS/TLS setup"""
+    if not http_client or count <= 0:
+        return 0
+
+    async def touch():
+        try:
+            # Any HTTP response means the connection is established and back in the pool
+            await asyncio.to_thread(http_client.get, base_url, timeout=WARMUP_TIMEOUT)
+            return True
+        except Exception as e:
+            print(f"Warm-up request failed: {e}")
+            return False
+
+    results = await asyncio.gather(*[touch() for _ in range(count)])
+    return sum(results)
+
+
+def setup_tracing():
+    """Configure an OpenTelemetry tracer with a local JSON-lines exporter"""
+    global tracer, trace_export_stream
+
+    if not TRACING_SUPPORT or not TRACING_ENABLED:
+        return None
+
+    if TRACE_EXPORT_FILE:
+        trace_export_stream = open(TRACE_EXPORT_FILE, "a", encoding="utf-8")
+
+    exporter = ConsoleSpanExporter(
+        out=trace_export_stream or sys.stdout,
+        formatter=lambda s: s.to_json(indent=None) + os.linesep
+    )
+    provider = TracerProvider(resource=Resource.create({"service.name": "invoice-ocr"}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    tracer = provider.get_tracer("invoice-ocr")
+    return provider
+
+
+@contextmanager
+def span(name: str, end_on_exit: bool = True, **attributes):
+    """Start a tracing span; a no-op when tracing is unavailable"""
+    if tracer is None:
+        yield None
+        return
+
+    with tracer.start_as_current_span(name, attributes=attributes, end_on_exit=end_on_exit) as current:
+        yield current
+
+
+def init_groq():
+    global groq_client
+
+    # Initialize Groq
+    groq_api_key = os.getenv("GROQ_API_KEY")
+    groq_model = os.getenv("GROQ_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct")
+    
+    if not groq_api_key or "your_" in groq_api_key.lower():
+        print("ERROR: GROQ_API_KEY not set or using placeholder")
+        print("Get your key at: https://console.groq.com/keys")
+        groq_client = None
+    else:
+        try:
+            groq_client = OpenAI(
+                api_key=groq_api_key,
+                base_url=groq_base_url(),
+                http_client=http_client
+            )
+            print(f"Groq API: Connected")
+            print(f"Model: {groq_model}")
+        except Exception as e:
+            print(f"Groq API: Failed to initialize - {e}")
+            groq_client = None
+
+
+def init_gemini():
+    global gemini_model
+
+    # Initialize Gemini
+    gemini_api_key = os.getenv("GEMINI_API_KEY") or os.getenv("OPENAI_API_KEY")
+    gemini_model_name = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+    
+    if not gemini_api_key or "your_" in gemini_api_key.lower():
+        print("ERROR: GEMINI_API_KEY not set or using placeholder")
+        print("Get your key at: https://aistudio.google.com/apikey")
+        gemini_model = None
+    else:
+        try:
+            genai.configure(api_key=gemini_api_key)
+            gemini_model = genai.GenerativeModel(gemini_model_name)
+            print(f"Gemini API: Connected")
+            print(f"Model: {gemini_model_name}")
+        except Exception as e:
+            print(f"Gemini API: Failed to initialize - {e}")
+            gemini_model = None
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global gemini_model, groq_client, ocr_mode
+    global gemini_model, groq_client, http_client, preprocess_pool, ocr_mode, fallback_mode, warmed_up, tracer, trace_export_stream
 
     print("=" * 70)
     print("Invoice OCR Service Starting (Multi-Provider)")
@@ -78,53 +315,70 @@ async def lifespan(app: FastAPI):
     else:
         print("PDF Support: Disabled (install poppler)")
 
+    if PREPROCESS_ENABLED and PREPROCESS_SUPPORT:
+        # Provider/exporter threads exist by the time pages arrive, so don't fork workers
+        preprocess_pool = ProcessPoolExecutor(
+            max_workers=PREPROCESS_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        # Spawn them now, so the first pages don't wait for a worker to start
+        worker_start = time.monotonic()
+        await asyncio.gather(*[
+            asyncio.wrap_future(preprocess_pool.submit(preprocess.start_worker))
+            for _ in range(PREPROCESS_WORKERS)
+        ])
+        print(f"Page Cleanup: Enabled ({PREPROCESS_WORKERS} worker(s) "
+              f"started in {time.monotonic() - worker_start:.2f}s)")
+    elif PREPROCESS_ENABLED:
+        print("Page Cleanup: Disabled (install numpy)")
+
+    tracer_provider = setup_tracing()
+    if tracer_provider:
+        print(f"Tracing: Enabled ({TRACE_EXPORT_FILE or 'stdout'})")
+    elif TRACING_ENABLED:
+        print("Tracing: Disabled (install opentelemetry-sdk)")
+
     print(f"OCR Mode: {ocr_mode.upper()}")
     print("-" * 70)
 
+    # Shared connection pool, handed to the Groq SDK so warmed connections are reused
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=max(MAX_CONCURRENT_PAGES, WARMUP_CONNECTIONS),
+            max_keepalive_connections=max(MAX_CONCURRENT_PAGES, WARMUP_CONNECTIONS)
+        )
+    )
+
     # Initialize based on mode
     if ocr_mode == "groq":
-        # Initialize Groq
-        groq_api_key = os.getenv("GROQ_API_KEY")
-        groq_model = os.getenv("GROQ_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct")
-        
-        if not groq_api_key or "your_" in groq_api_key.lower():
-            print("ERROR: GROQ_API_KEY not set or using placeholder")
-            print("Get your key at: https://console.groq.com/keys")
-            groq_client = None
-        else:
-            try:
-                groq_client = OpenAI(
-                    api_key=groq_api_key,
-                    base_url="https://api.groq.com/openai/v1"
-                )
-                print(f"Groq API: Connected")
-                print(f"Model: {groq_model}")
-            except Exception as e:
-                print(f"Groq API: Failed to initialize - {e}")
-                groq_client = None
-    
+        init_groq()
     elif ocr_mode == "gemini":
-        # Initialize Gemini
-        gemini_api_key = os.getenv("GEMINI_API_KEY") or os.getenv("OPENAI_API_KEY")
-        gemini_model_name = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
-        
-        if not gemini_api_key or "your_" in gemini_api_key.lower():
-            print("ERROR: GEMINI_API_KEY not set or using placeholder")
-            print("Get your key at: https://aistudio.google.com/apikey")
-            gemini_model = None
-        else:
-            try:
-                genai.configure(api_key=gemini_api_key)
-                gemini_model = genai.GenerativeModel(gemini_model_name)
-                print(f"Gemini API: Connected")
-                print(f"Model: {gemini_model_name}")
-            except Exception as e:
-                print(f"Gemini API: Failed to initialize - {e}")
-                gemini_model = None
-    
+        init_gemini()
     else:
         print(f"ERROR: Invalid OCR_MODE '{ocr_mode}'. Use 'gemini' or 'groq'")
 
+    # Optional second provider, used to re-extract pages that fail validation
+    fallback_mode = os.getenv("FALLBACK_OCR_MODE", "").lower() or None
+    if fallback_mode == ocr_mode or fallback_mode not in (None, "groq", "gemini"):
+        print(f"Fallback OCR Mode: ignoring '{fallback_mode}'")
+        fallback_mode = None
+    if fallback_mode:
+        print("-" * 70)
+        print(f"Fallback OCR Mode: {fallback_mode.upper()}")
+        if fallback_mode == "groq":
+            init_groq()
+        else:
+            init_gemini()
+
+    # The Gemini SDK keeps its own transport, so only the Groq pool can be warmed
+    if ocr_mode == "groq" and provider_connected("groq"):
+        base_url = groq_base_url()
+        warm_start = time.monotonic()
+        opened = await warm_up_connections(base_url, WARMUP_CONNECTIONS)
+        print(f"Warm-up: {opened}/{WARMUP_CONNECTIONS} connection(s) to {base_url} "
+              f"in {time.monotonic() - warm_start:.2f}s")
+    warmed_up = True
+
     print("=" * 70)
     print(f"Server ready at http://localhost:8000")
     print(f"API docs at http://localhost:8000/docs")
@@ -134,6 +388,18 @@ async def lifespan(app: FastAPI):
 
     gemini_model = None
     groq_client = None
+    if http_client:
+        http_client.close()
+        http_client = None
+    if preprocess_pool:
+        preprocess_pool.shutdown(cancel_futures=True)
+        preprocess_pool = None
+    if tracer_provider:
+        tracer_provider.shutdown()
+        tracer = None
+    if trace_export_stream:
+        trace_export_stream.close()
+        trace_export_stream = None
     print("Service shutdown complete")
 
 
@@ -145,6 +411,84 @@ app = FastAPI(
 )
 
 
+def prune_profiles(keep: int):
+    """Delete all but the `keep` newest profile reports"""
+    try:
+        reports = sorted(Path(PROFILE_DIR).glob("*.html"), key=lambda p: p.stat().st_mtime, reverse=True)
+        for report in reports[max(keep, 1):]:
+            report.unlink(missing_ok=True)
+    except OSError as e:
+        print(f"Failed to prune profiles: {e}")
+
+
+@app.middleware("http")
+async def trace_and_profile(request: Request, call_next):
+    """Wrap each request in a root span, return its trace ID and optionally profile it"""
+    profile = request.headers.get("x-profile") == "1"
+
+    if profile:
+        token = request.headers.get("x-admin-token", "")
+        if not ADMIN_TOKEN or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return JSONResponse(status_code=403, content={"detail": "Profiling requires a valid X-Admin-Token"})
+        if not PROFILING_SUPPORT:
+            return JSONResponse(status_code=503, content={"detail": "Profiling not available. Install pyinstrument."})
+
+    # call_next returns once the headers are ready; streamed bodies (NDJSON batches) are
+    # still being produced, so the span and profiler are only finished with the body
+    with span(
+        "http_request",
+        end_on_exit=False,
+        **{"http.method": request.method, "http.target": request.url.path}
+    ) as current:
+        if current is not None:
+            trace_id = format(current.get_span_context().trace_id, "032x")
+        else:
+            trace_id = uuid.uuid4().hex
+
+        profiler = None
+        profile_path = None
+        if profile:
+            profiler = Profiler(async_mode="enabled")
+            profiler.start()
+            profile_path = os.path.join(PROFILE_DIR, f"{trace_id}.html")
+
+        def finish():
+            if profiler and profiler.is_running:
+                profiler.stop()
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                with open(profile_path, "w", encoding="utf-8") as f:
+                    f.write(profiler.output_html())
+                print(f"Profile saved to {profile_path}")
+                prune_profiles(PROFILE_KEEP)
+            if current is not None and current.is_recording():
+                current.end()
+
+        try:
+            response = await call_next(request)
+        except BaseException:
+            finish()
+            raise
+
+        if current is not None:
+            current.set_attribute("http.status_code", response.status_code)
+
+    response.headers["X-Trace-Id"] = trace_id
+    if profile_path:
+        response.headers["X-Profile-Path"] = profile_path
+
+    body = response.body_iterator
+
+    async def finish_with_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            finish()
+
+    response.body_iterator = finish_with_body()
+    return response
+
+
 def is_pdf(filename: str) -> bool:
     return filename.lower().endswith(".pdf")
 
@@ -165,33 +509,99 @@ async def pdf_to_images(pdf_path: str, dpi: int = 300) -> List[str]:
     temp_dir = tempfile.mkdtemp()
     
     try:
-        images = convert_from_path(pdf_path, dpi=dpi)
+        # Pages go straight to disk, off the event loop, so large batches don't sit in memory
+        with span("rasterize", dpi=dpi):
+            paths = await asyncio.to_thread(
+                convert_from_path,
+                pdf_path,
+                dpi=dpi,
+                output_folder=temp_dir,
+                fmt="jpeg",
+                output_file="page",
+                paths_only=True
+            )
     except Exception as e:
         raise HTTPException(500, f"Failed to convert PDF: {str(e)}")
 
-    paths = []
-    for i, img in enumerate(images):
-        p = os.path.join(temp_dir, f"page_{i}.jpg")
-        img.save(p, "JPEG")
-        paths.append(p)
-
     return paths
 
 
+async def rasterize_pdf_page(pdf_path: str, page_index: int, dpi: int) -> str:
+    """Render one PDF page (0-based) to a JPEG in its own temp directory"""
+    with span("rasterize", dpi=dpi, page=page_index):
+        images = await asyncio.to_thread(
+            convert_from_path,
+            pdf_path,
+            dpi=dpi,
+            first_page=page_index + 1,
+            last_page=page_index + 1
+        )
+
+    p = os.path.join(tempfile.mkdtemp(), f"page_{page_index}_{dpi}dpi.jpg")
+    images[0].save(p, "JPEG")
+    return p
+
+
+def discard_cleaned_page(future: Future):
+    """Remove a cleaned page nobody is waiting for any more (its request was cancelled)"""
+    if future.cancelled() or future.exception():
+        return
+
+    path = future.result()["path"]
+    if "_clean." not in Path(path).name:
+        return
+    try:
+        os.remove(path)
+        # cleanup() may already have tried to remove the page's temp directory
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+
+
+async def preprocess_page(image_path: str) -> Tuple[str, Optional[PreprocessingStats]]:
+    """Clean up a page in the worker pool, keeping the event loop free"""
+    if preprocess_pool is None:
+        return image_path, None
+
+    with span("preprocess_page", image=Path(image_path).name):
+        future = preprocess_pool.submit(preprocess.clean_page_image, image_path)
+        try:
+            info = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # A running worker can't be stopped; delete its output once it finishes
+            future.add_done_callback(discard_cleaned_page)
+            raise
+        except Exception as e:
+            print(f"Page cleanup failed for {Path(image_path).name}: {e}")
+            return image_path, None
+
+    path = info.pop("path")
+    stats = PreprocessingStats(**info)
+    print(f"Cleaned {Path(image_path).name} in {stats.seconds}s: "
+          f"{stats.input_bytes} -> {stats.output_bytes} bytes, "
+          f"rotated {stats.rotated_degrees}, skew {stats.skew_degrees}, cropped {stats.cropped}")
+    return path, stats
+
+
 def encode_image_base64(image_path: str) -> str:
     """Encode image to base64 for Groq API"""
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode('utf-8')
 
 
-async def process_single_image_groq(image_path: str) -> Dict[str, Any]:
+async def process_single_image_groq(
+    image_path: str,
+    timeout: Optional[float] = None,
+    hint: Optional[str] = None
+) -> Dict[str, Any]:
     """Process image using Groq API"""
     if not groq_client:
         return {}
 
     try:
         # Encode image to base64
-        base64_image = encode_image_base64(image_path)
+        with span("encode_image", image=Path(image_path).name):
+            base64_image = encode_image_base64(image_path)
         
         # Determine image format
         ext = Path(image_path).suffix.lower()
@@ -216,6 +626,8 @@ async def process_single_image_groq(image_path: str) -> Dict[str, Any]:
   "tax_amount": number or null,
   "discount_amount": number or null,
   "currency": "string or null",
+  "page_number": number or null,
+  "total_pages": number or null,
   "line_items": [
     {
       "item_name": "string",
@@ -229,28 +641,36 @@ async def process_single_image_groq(image_path: str) -> Dict[str, Any]:
 }
 
 If a field is not present, use null.
+page_number and total_pages come from page labels such as "Page 2 of 3".
 Return ONLY the JSON.'''
+        if hint:
+            prompt += "\n\n" + hint
 
         groq_model = os.getenv("GROQ_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct")
         
-        response = groq_client.chat.completions.create(
-            model=groq_model,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{mime_type};base64,{base64_image}"
+        # Run the blocking SDK call off the event loop so the request deadline can cancel it.
+        # Cancelling only abandons the thread, so the SDK must not retry past the deadline.
+        with span("provider_call", provider="groq", model=groq_model):
+            response = await asyncio.to_thread(
+                groq_client.with_options(max_retries=0).chat.completions.create,
+                model=groq_model,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {"type": "text", "text": prompt},
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": f"data:{mime_type};base64,{base64_image}"
+                                }
                             }
-                        }
-                    ]
-                }
-            ],
-            temperature=0.0
-        )
+                        ]
+                    }
+                ],
+                temperature=0.0,
+                timeout=timeout
+            )
         
         content = response.choices[0].message.content
         
@@ -266,7 +686,8 @@ Return ONLY the JSON.'''
         print(content)
         print("=" * 50)
         
-        result = json.loads(content)
+        with span("parse", chars=len(content)):
+            result = json.loads(content)
         print(f"Extracted from {Path(image_path).name}")
         return result
         
@@ -283,13 +704,19 @@ Return ONLY the JSON.'''
         return {}
 
 
-async def process_single_image_gemini(image_path: str) -> Dict[str, Any]:
+async def process_single_image_gemini(
+    image_path: str,
+    timeout: Optional[float] = None,
+    hint: Optional[str] = None
+) -> Dict[str, Any]:
     """Process image using Gemini API"""
     if not gemini_model:
         return {}
 
     try:
-        img = Image.open(image_path)
+        with span("encode_image", image=Path(image_path).name):
+            img = Image.open(image_path)
+            img.load()
         
         prompt = '''Extract invoice data and return ONLY valid JSON with this exact structure:
 
@@ -305,6 +732,8 @@ async def process_single_image_gemini(image_path: str) -> Dict[str, Any]:
   "tax_amount": number or null,
   "discount_amount": number or null,
   "currency": "string or null",
+  "page_number": number or null,
+  "total_pages": number or null,
   "line_items": [
     {
       "item_name": "string",
@@ -318,10 +747,19 @@ async def process_single_image_gemini(image_path: str) -> Dict[str, Any]:
 }
 
 If a field is not present, use null.
+page_number and total_pages come from page labels such as "Page 2 of 3".
 Return ONLY the JSON.
 '''
-
-        response = gemini_model.generate_content([prompt, img])
+        if hint:
+            prompt += "\n" + hint + "\n"
+
+        with span("provider_call", provider="gemini", model=gemini_model.model_name):
+            response = await asyncio.to_thread(
+                gemini_model.generate_content,
+                [prompt, img],
+                # No SDK retries; the deadline is enforced around this call
+                request_options={"timeout": timeout, "retry": None} if timeout else None
+            )
         content = response.text
         
         if "`json" in content:
@@ -335,7 +773,8 @@ Return ONLY the JSON.
         print(content)
         print("=" * 50)
         
-        result = json.loads(content)
+        with span("parse", chars=len(content)):
+            result = json.loads(content)
         print(f"Extracted from {Path(image_path).name}")
         return result
         
@@ -350,17 +789,271 @@ Return ONLY the JSON.
         return {}
 
 
-async def process_single_image(image_path: str) -> Dict[str, Any]:
-    """Route to appropriate OCR provider based on mode"""
-    if ocr_mode == "groq":
-        return await process_single_image_groq(image_path)
-    elif ocr_mode == "gemini":
-        return await process_single_image_gemini(image_path)
+async def process_single_image(
+    image_path: str,
+    timeout: Optional[float] = None,
+    provider: Optional[str] = None,
+    hint: Optional[str] = None
+) -> Dict[str, Any]:
+    """Route to appropriate OCR provider based on mode (or an explicit provider)"""
+    mode = provider or ocr_mode
+    if mode == "groq":
+        return await process_single_image_groq(image_path, timeout, hint)
+    elif mode == "gemini":
+        return await process_single_image_gemini(image_path, timeout, hint)
     else:
-        print(f"Invalid OCR mode: {ocr_mode}")
+        print(f"Invalid OCR mode: {mode}")
         return {}
 
 
+def parse_request_timeout(
+    header_value: Optional[str],
+    default: float = DEFAULT_REQUEST_TIMEOUT,
+    maximum: float = MAX_REQUEST_TIMEOUT
+) -> float:
+    """Resolve the request budget in seconds from X-Request-Timeout or config"""
+    if header_value is None:
+        return default
+
+    try:
+        timeout = float(header_value)
+    except ValueError:
+        raise HTTPException(400, f"Invalid X-Request-Timeout: {header_value}")
+
+    # NaN would slip past every deadline comparison
+    if not math.isfinite(timeout) or timeout <= 0:
+        raise HTTPException(400, "X-Request-Timeout must be a finite number greater than 0")
+
+    return min(timeout, maximum)
+
+
+def parse_page_selection(pages: Optional[str], page_count: int) -> Optional[Set[int]]:
+    """Parse a comma-separated list of page indices, e.g. "0,3,4" """
+    if not pages:
+        return None
+
+    selected = set()
+    for part in pages.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if not part.isdigit() or int(part) >= page_count:
+            raise HTTPException(
+                400,
+                f"Invalid page index '{part}'. Document has {page_count} page(s)"
+            )
+        selected.add(int(part))
+
+    return selected
+
+
+async def process_page(
+    image_path: str,
+    deadline: float,
+    provider: Optional[str] = None,
+    hint: Optional[str] = None,
+    reextract: bool = False,
+    on_send: Optional[Callable[[], None]] = None
+) -> Tuple[Dict[str, Any], float]:
+    """
+    Process one page with whatever is left of the request budget.
+    `on_send` is called once the page is actually sent to the provider; a page that
+    only gets a slot after the deadline is not sent and returns no result.
+    If the caller gives up (deadline, disconnect), the provider call can't be
+    interrupted: it keeps its slot and counts as in flight until its thread returns.
+    """
+    global pages_in_flight, pages_queued
+
+    semaphore = reextract_semaphore if reextract else page_semaphore
+    pages_queued += 1
+    try:
+        await semaphore.acquire()
+    finally:
+        pages_queued -= 1
+
+    if time.monotonic() >= deadline:
+        semaphore.release()
+        return {}, 0.0
+
+    if on_send:
+        on_send()
+    pages_in_flight += 1
+    started = time.monotonic()
+
+    async def call() -> Dict[str, Any]:
+        with span("page", image=Path(image_path).name) as current:
+            result = await process_single_image(
+                image_path,
+                timeout=deadline - started,
+                provider=provider,
+                hint=hint
+            )
+            if current is not None:
+                current.set_attribute("ok", bool(result))
+            return result
+
+    def finished(task: asyncio.Task):
+        global pages_in_flight
+        pages_in_flight -= 1
+        semaphore.release()
+        abandoned_calls.discard(task)
+        ok = not task.cancelled() and task.exception() is None and bool(task.result())
+        provider_calls.append((time.monotonic() - started, ok))
+
+    task = asyncio.create_task(call())
+    task.add_done_callback(finished)
+    try:
+        result = await asyncio.shield(task)
+    except asyncio.CancelledError:
+        abandoned_calls.add(task)
+        raise
+
+    return result, round(time.monotonic() - started, 2)
+
+
+async def extract_page(
+    image_path: str,
+    deadline: float,
+    on_send: Optional[Callable[[], None]] = None
+) -> Tuple[Dict[str, Any], float, Optional[PreprocessingStats]]:
+    """Clean up a page, then extract it"""
+    cleaned, preprocessing = await preprocess_page(image_path)
+    try:
+        result, elapsed = await process_page(cleaned, deadline, on_send=on_send)
+    finally:
+        if cleaned != image_path and os.path.exists(cleaned):
+            os.remove(cleaned)
+    return result, elapsed, preprocessing
+
+
+def page_status(i: int, result: Dict[str, Any], elapsed: float, deadline: float) -> PageStatus:
+    if result:
+        return PageStatus(page_index=i, status="ok", elapsed_seconds=elapsed)
+    if time.monotonic() >= deadline:
+        # Provider call gave up on the propagated timeout
+        return PageStatus(
+            page_index=i,
+            status="timeout",
+            elapsed_seconds=elapsed,
+            error="Provider call timed out"
+        )
+    return PageStatus(
+        page_index=i,
+        status="failed",
+        elapsed_seconds=elapsed,
+        error="No data extracted. Check server logs for details."
+    )
+
+
+async def iter_pages(
+    image_paths: List[str],
+    deadline: float,
+    selected: Optional[Set[int]] = None
+) -> AsyncIterator[Tuple[int, Dict[str, Any], PageStatus]]:
+    """
+    Process pages concurrently until the deadline, yielding (page_index, result, status)
+    as each page finishes. At most MAX_PAGES_PER_REQUEST pages are dispatched at a time.
+    Pages still running at the deadline are cancelled and reported as "timeout";
+    pages not sent to the provider before the deadline (not dispatched, or still
+    being cleaned up or waiting for a slot) are "skipped".
+    """
+    waiting = [
+        (i, path) for i, path in enumerate(image_paths)
+        if selected is None or i in selected
+    ]
+    waiting.reverse()
+    tasks: Dict[asyncio.Task, int] = {}
+    pending = set()
+    sent: Set[int] = set()
+
+    def skipped(i: int) -> PageStatus:
+        return PageStatus(
+            page_index=i,
+            status="skipped",
+            error="Deadline reached before page was sent to the provider"
+        )
+
+    def dispatch():
+        while waiting and len(pending) < max(MAX_PAGES_PER_REQUEST, 1):
+            i, path = waiting.pop()
+            task = asyncio.create_task(extract_page(path, deadline, lambda i=i: sent.add(i)))
+            tasks[task] = i
+            pending.add(task)
+
+    try:
+        dispatch()
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=remaining,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            if time.monotonic() < deadline:
+                dispatch()
+
+            for task in sorted(done, key=tasks.get):
+                i = tasks[task]
+                try:
+                    result, elapsed, preprocessing = task.result()
+                except Exception as e:
+                    yield i, {}, PageStatus(page_index=i, status="failed", error=str(e))
+                    continue
+                if not result and i not in sent:
+                    yield i, {}, skipped(i)
+                    continue
+                status = page_status(i, result, elapsed, deadline)
+                status.preprocessing = preprocessing
+                yield i, result, status
+
+        stragglers = sorted(pending, key=tasks.get)
+        for task in stragglers:
+            task.cancel()
+        if stragglers:
+            await asyncio.gather(*stragglers, return_exceptions=True)
+        pending = set()
+
+        for task in stragglers:
+            i = tasks[task]
+            if i not in sent:
+                yield i, {}, skipped(i)
+                continue
+            yield i, {}, PageStatus(
+                page_index=i,
+                status="timeout",
+                error="Page did not finish before the request deadline"
+            )
+
+        while waiting:
+            i, _ = waiting.pop()
+            yield i, {}, skipped(i)
+
+    finally:
+        # Consumer stopped early (e.g. a streaming client disconnected)
+        for task in pending:
+            task.cancel()
+
+
+async def process_pages(
+    image_paths: List[str],
+    deadline: float,
+    selected: Optional[Set[int]] = None
+) -> Tuple[Dict[int, Dict[str, Any]], Dict[int, PageStatus]]:
+    """Process pages until the deadline; returns results of successful pages and every page's status"""
+    results: Dict[int, Dict[str, Any]] = {}
+    statuses: Dict[int, PageStatus] = {}
+
+    async for i, result, status in iter_pages(image_paths, deadline, selected):
+        statuses[i] = status
+        if result:
+            results[i] = result
+
+    return results, statuses
+
+
 def merge_invoice_data(results: List[Dict[str, Any]]) -> Dict[str, Any]:
     if not results:
         return {
@@ -430,6 +1123,242 @@ def merge_invoice_data(results: List[Dict[str, Any]]) -> Dict[str, Any]:
     return merged
 
 
+INVOICE_HEADER_FIELDS = ["customer_name", "customer_gstin", "customer_phone", "invoice_date"]
+
+
+def normalize_field(value: Any) -> str:
+    return " ".join(str(value).lower().split()) if value else ""
+
+
+def page_number_field(value: Any) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def header_similarity(page: Dict[str, Any], header: Dict[str, Any]) -> Optional[float]:
+    """Average similarity of the header fields both sides carry, or None if they share none"""
+    scores = []
+    for k in INVOICE_HEADER_FIELDS:
+        a, b = normalize_field(page.get(k)), normalize_field(header.get(k))
+        if a and b:
+            scores.append(SequenceMatcher(None, a, b).ratio())
+    return sum(scores) / len(scores) if scores else None
+
+
+def starts_new_invoice(page: Dict[str, Any], header: Dict[str, Any], previous: Dict[str, Any]) -> bool:
+    """Decide whether `page` begins a new invoice, given the current invoice's header and the previous page"""
+    # Invoice numbers are the strongest cue when both sides have one
+    number = normalize_field(page.get("invoice_number"))
+    current_number = normalize_field(header.get("invoice_number"))
+    if number and current_number:
+        return number != current_number
+
+    # Page labels such as "Page 1 of 3"
+    page_number = page_number_field(page.get("page_number"))
+    previous_number = page_number_field(previous.get("page_number"))
+    previous_total = page_number_field(previous.get("total_pages"))
+    if page_number == 1:
+        return True
+    if previous_number and previous_total and previous_number >= previous_total:
+        return True
+    if page_number and previous_number and page_number == previous_number + 1:
+        return False
+
+    # Fall back to comparing customer details and date
+    similarity = header_similarity(page, header)
+    if similarity is not None:
+        return similarity < SPLIT_HEADER_SIMILARITY
+
+    # Continuation pages usually carry no header at all
+    return False
+
+
+def split_invoice_pages(results: List[Dict[str, Any]]) -> List[List[int]]:
+    """
+    Group consecutive page results into invoices.
+    Returns lists of positions into `results`; empty (failed) pages stay with the current invoice.
+    """
+    groups: List[List[int]] = []
+    header: Dict[str, Any] = {}
+    previous: Dict[str, Any] = {}
+
+    for i, page in enumerate(results):
+        if not groups or (page and starts_new_invoice(page, header, previous)):
+            groups.append([])
+            header = {}
+
+        groups[-1].append(i)
+
+        if page:
+            for k in INVOICE_HEADER_FIELDS + ["invoice_number"]:
+                if not header.get(k) and page.get(k):
+                    header[k] = page[k]
+            previous = page
+
+    return groups
+
+
+def as_amount(value: Any) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def amounts_match(a: float, b: float) -> bool:
+    return abs(a - b) <= max(0.5, VALIDATION_TOLERANCE * max(abs(a), abs(b)))
+
+
+def validate_line_items(result: Dict[str, Any]) -> List[str]:
+    """Check quantity x price (with or without tax) against each item_total"""
+    issues = []
+    for item in result.get("line_items") or []:
+        if not isinstance(item, dict):
+            continue
+        quantity = as_amount(item.get("item_quantity"))
+        price = as_amount(item.get("item_price"))
+        total = as_amount(item.get("item_total"))
+        if quantity is None or price is None or total is None:
+            continue
+
+        expected = quantity * price
+        tax = as_amount(item.get("item_tax_percentage")) or 0.0
+        if not (amounts_match(expected, total) or amounts_match(expected * (1 + tax / 100), total)):
+            issues.append(
+                f"Line item '{item.get('item_name')}': {quantity} x {price} does not match item_total {total}"
+            )
+    return issues
+
+
+def validate_invoice(results: Dict[int, Dict[str, Any]]) -> Dict[int, List[str]]:
+    """
+    Local arithmetic and consistency checks for the pages of one invoice.
+    Returns issues keyed by the page that should be re-extracted.
+    """
+    pages = sorted(i for i, r in results.items() if r)
+    if not pages:
+        return {}
+
+    issues = {i: validate_line_items(results[i]) for i in pages}
+
+    missing = [
+        f for f in REQUIRED_FIELDS
+        if not any(results[i].get(f) not in (None, "") for i in pages)
+    ]
+    if missing:
+        # Header fields are printed on the first page
+        issues[pages[0]].append(f"Missing required field(s): {', '.join(missing)}")
+
+    # Amounts are summed across pages, the same way merge_invoice_data does
+    def page_sum(field: str) -> Optional[float]:
+        values = [as_amount(results[i].get(field)) for i in pages]
+        values = [v for v in values if v is not None]
+        return sum(values) if values else None
+
+    items = [item for i in pages for item in results[i].get("line_items") or []]
+    item_totals = [as_amount(item.get("item_total")) if isinstance(item, dict) else None for item in items]
+    total = page_sum("total_amount")
+
+    if items and total is not None and None not in item_totals:
+        subtotal = sum(item_totals)
+        tax = page_sum("tax_amount") or 0.0
+        discount = page_sum("discount_amount") or 0.0
+        # Per-line tax (e.g. GST) when item_total is before tax
+        with_line_tax = sum(
+            t * (1 + (as_amount(item.get("item_tax_percentage")) or 0.0) / 100)
+            for t, item in zip(item_totals, items)
+        )
+        expected = [
+            subtotal,
+            subtotal + tax,
+            subtotal - discount,
+            subtotal + tax - discount,
+            with_line_tax,
+            with_line_tax - discount
+        ]
+
+        if not any(amounts_match(e, total) for e in expected):
+            message = f"Line items add up to {round(subtotal, 2)} but total_amount is {total}"
+            for i in pages:
+                if results[i].get("line_items") or results[i].get("total_amount") is not None:
+                    issues[i].append(message)
+
+    return {i: found for i, found in issues.items() if found}
+
+
+def reextraction_hint(issues: List[str]) -> str:
+    return (
+        "A previous extraction of this page failed these checks:\n"
+        + "\n".join(f"- {issue}" for issue in issues)
+        + "\nRe-read the header fields, quantities, prices and totals and copy them exactly as printed."
+    )
+
+
+async def refine_pages(
+    image_paths: List[str],
+    results: Dict[int, Dict[str, Any]],
+    statuses: Dict[int, PageStatus],
+    deadline: float,
+    max_pages: int,
+    pdf_path: Optional[str] = None,
+    temp_files: Optional[List[str]] = None
+) -> int:
+    """
+    Re-extract the pages of one invoice that fail validation, up to `max_pages` pages
+    and REEXTRACT_ATTEMPTS attempts each, at REEXTRACT_DPI (PDFs) with a prompt naming
+    the failed checks. Later attempts use the fallback provider when one is configured.
+    Better results replace the originals in `results`; returns the number of pages retried.
+    """
+    issues = validate_invoice(results)
+    targets = sorted(issues)[:max(max_pages, 0)]
+    high_res: Dict[int, str] = {}
+
+    async def reextract(i: int, provider: str, hint: str) -> Dict[str, Any]:
+        if pdf_path and PDF_SUPPORT and i not in high_res:
+            high_res[i] = await rasterize_pdf_page(pdf_path, i, REEXTRACT_DPI)
+            if temp_files is not None:
+                temp_files.append(high_res[i])
+        result, _ = await process_page(
+            high_res.get(i, image_paths[i]), deadline, provider, hint, reextract=True
+        )
+        return result
+
+    for attempt in range(REEXTRACT_ATTEMPTS):
+        pending = [i for i in targets if i in issues]
+        if not pending or deadline - time.monotonic() <= 0:
+            break
+
+        provider = fallback_mode if attempt > 0 and provider_connected(fallback_mode) else ocr_mode
+        print(f"Re-extracting page(s) {pending} with {provider} (attempt {attempt + 1})")
+
+        tasks = {
+            asyncio.create_task(reextract(i, provider, reextraction_hint(issues[i]))): i
+            for i in pending
+        }
+        done, stragglers = await asyncio.wait(tasks.keys(), timeout=max(deadline - time.monotonic(), 0))
+        for task in stragglers:
+            task.cancel()
+        if stragglers:
+            await asyncio.gather(*stragglers, return_exceptions=True)
+
+        for task in sorted(done, key=tasks.get):
+            i = tasks[task]
+            statuses[i].reextractions += 1
+            if task.exception() or not task.result():
+                continue
+            # Keep the new extraction only if it fixes some of this page's problems
+            if len(validate_invoice({**results, i: task.result()}).get(i, [])) < len(issues[i]):
+                results[i] = task.result()
+
+        issues = validate_invoice(results)
+
+    for i in results:
+        statuses[i].issues = issues.get(i, [])
+    return len(targets)
+
+
 async def cleanup(paths: List[str]):
     for p in paths:
         try:
@@ -445,6 +1374,222 @@ async def cleanup(paths: List[str]):
             print(f"Cleanup warning: {e}")
 
 
+def check_provider_available():
+    """Raise 503 when the configured OCR provider is not usable"""
+    if ocr_mode == "groq" and not groq_client:
+        raise HTTPException(
+            503,
+            "Groq API not available. Set GROQ_API_KEY in .env"
+        )
+    elif ocr_mode == "gemini" and not gemini_model:
+        raise HTTPException(
+            503,
+            "Gemini API not available. Set GEMINI_API_KEY in .env"
+        )
+    elif ocr_mode not in ["groq", "gemini"]:
+        raise HTTPException(
+            503,
+            f"Invalid OCR_MODE '{ocr_mode}'. Set OCR_MODE to 'gemini' or 'groq' in .env"
+        )
+
+
+async def save_uploads(files: List[UploadFile], temp_files: List[str]) -> Tuple[List[str], Optional[str]]:
+    """Write uploads to temp files; returns one image path per page and the PDF path, if any"""
+    image_paths = []
+    pdf_path = None
+
+    if len(files) == 1:
+        f = files[0]
+
+        with tempfile.NamedTemporaryFile(
+            delete=False,
+            suffix=Path(f.filename).suffix
+        ) as tmp:
+            with span("upload", filename=f.filename):
+                tmp.write(await f.read())
+            temp_files.append(tmp.name)
+
+        if is_pdf(f.filename):
+            print(f"Processing PDF: {f.filename}")
+            pdf_path = tmp.name
+            image_paths = await pdf_to_images(tmp.name)
+            temp_files.extend(image_paths)
+
+        elif is_image(f.filename):
+            print(f"Processing image: {f.filename}")
+            image_paths = [tmp.name]
+
+        else:
+            raise HTTPException(
+                400,
+                f"Unsupported file type: {f.filename}"
+            )
+
+    else:
+        print(f"Processing {len(files)} files")
+
+        for f in files:
+            if not is_image(f.filename):
+                raise HTTPException(
+                    400,
+                    f"Multiple files must all be images. Found: {f.filename}"
+                )
+
+            with tempfile.NamedTemporaryFile(
+                delete=False,
+                suffix=Path(f.filename).suffix
+            ) as tmp:
+                with span("upload", filename=f.filename):
+                    tmp.write(await f.read())
+                temp_files.append(tmp.name)
+                image_paths.append(tmp.name)
+
+    return image_paths, pdf_path
+
+
+def build_invoice_response(
+    results: List[Dict[str, Any]],
+    page_statuses: List[PageStatus],
+    start_time: float
+) -> InvoiceResponse:
+    """Merge page results into one invoice and attach per-page status"""
+    print(f"Merging data from {len(results)} result(s)...")
+    with span("merge_invoice_data", results=len(results)):
+        merged = merge_invoice_data(results)
+
+    # Ensure currency is always a string
+    if not merged.get("currency") or not isinstance(merged.get("currency"), str):
+        merged["currency"] = "INR"
+    
+    # Convert numeric fields to proper types or None
+    for field in ["total_amount", "tax_amount", "discount_amount"]:
+        if merged.get(field) == 0.0 and len(results) == 1:
+            # For single result, use original value (might be None)
+            if results[0].get(field) is None:
+                merged[field] = None
+
+    retry_pages = [s.page_index for s in page_statuses if s.status != "ok"]
+    
+    # Calculate processing time
+    end_time = time.time()
+    merged["processing_time_seconds"] = round(end_time - start_time, 2)
+    merged["partial"] = bool(retry_pages)
+    merged["pages"] = page_statuses
+    merged["retry_pages"] = retry_pages
+
+    if retry_pages:
+        print(f"Partial result: pages {retry_pages} need a retry")
+    return InvoiceResponse(**merged)
+
+
+async def iter_invoices(
+    image_paths: List[str],
+    deadline: float,
+    start_time: float,
+    pdf_path: Optional[str] = None,
+    temp_files: Optional[List[str]] = None,
+    selected: Optional[Set[int]] = None
+) -> AsyncIterator[InvoiceResponse]:
+    """
+    Extract every (selected) page, split the document at invoice boundaries and yield
+    each invoice in order as soon as its pages and the page after it are done.
+    Invoices are validated and re-extracted in their own tasks, so the first pass
+    over the remaining pages keeps going meanwhile. Pages after the last extracted
+    page (timed out, skipped or failed) belong to no known invoice and are yielded
+    last, on their own, with no invoice data.
+    """
+    order = [i for i in range(len(image_paths)) if selected is None or i in selected]
+    page_results: Dict[int, Dict[str, Any]] = {}
+    statuses: Dict[int, PageStatus] = {}
+    reextract_budget = REEXTRACT_MAX_PAGES
+    finished: asyncio.Queue = asyncio.Queue()
+    invoice_tasks: List[asyncio.Task] = []
+
+    async def finish_invoice(indices: List[int], max_pages: Optional[int]) -> InvoiceResponse:
+        results = {j: page_results[j] for j in indices if page_results[j]}
+        if max_pages is not None:
+            await refine_pages(
+                image_paths,
+                results,
+                {j: statuses[j] for j in indices},
+                deadline,
+                max_pages,
+                pdf_path,
+                temp_files
+            )
+        return build_invoice_response(
+            [results[j] for j in sorted(results)],
+            [statuses[j] for j in indices],
+            start_time
+        )
+
+    def queue_invoice(indices: List[int], max_pages: Optional[int]):
+        task = asyncio.create_task(finish_invoice(indices, max_pages))
+        invoice_tasks.append(task)
+        finished.put_nowait(task)
+
+    async def split_pages():
+        nonlocal reextract_budget
+        start = 0
+        try:
+            async for i, result, status in iter_pages(image_paths, deadline, selected):
+                page_results[i] = result
+                statuses[i] = status
+
+                # Only the finished prefix of the document can be split
+                end = start
+                while end < len(order) and order[end] in statuses:
+                    end += 1
+                if end == start:
+                    continue
+
+                prefix = order[start:end]
+                tail: List[int] = []
+                if end == len(order):
+                    extracted = [p for p, j in enumerate(prefix) if page_results[j]]
+                    cut = extracted[-1] + 1 if extracted else 0
+                    prefix, tail = prefix[:cut], prefix[cut:]
+
+                groups = split_invoice_pages([page_results[j] for j in prefix]) if prefix else []
+                # The last group may still continue onto pages that are not done yet
+                final = groups if end == len(order) else groups[:-1]
+
+                for group in final:
+                    indices = [prefix[j] for j in group]
+                    # Only invoices whose pages all came back can be validated (and not
+                    # page retries); the re-extraction budget is handed out in document order
+                    max_pages = None
+                    if selected is None and all(statuses[j].status == "ok" for j in indices):
+                        failing = len(validate_invoice({j: page_results[j] for j in indices}))
+                        max_pages = min(failing, max(reextract_budget, 0))
+                        reextract_budget -= max_pages
+
+                    queue_invoice(indices, max_pages)
+                    start += len(group)
+
+                if tail:
+                    queue_invoice(tail, None)
+        finally:
+            finished.put_nowait(None)
+
+    splitter = asyncio.create_task(split_pages())
+
+    try:
+        while True:
+            task = await finished.get()
+            if task is None:
+                break
+            yield await task
+        await splitter
+
+    finally:
+        # Consumer stopped early (e.g. a streaming client disconnected)
+        splitter.cancel()
+        for task in invoice_tasks:
+            task.cancel()
+        await asyncio.gather(splitter, *invoice_tasks, return_exceptions=True)
+
+
 @app.get("/health")
 async def health():
     provider_name = "Groq" if ocr_mode == "groq" else "Google Gemini"
@@ -461,115 +1606,165 @@ async def health():
     }
 
 
+@app.get("/ready")
+async def ready():
+    """Readiness for load balancers: 503 while warming up, disconnected or saturated"""
+    api_connected = provider_connected(ocr_mode)
+    saturated = pages_queued >= MAX_QUEUE_DEPTH
+
+    latencies = sorted(latency for latency, _ in provider_calls)
+    errors = sum(1 for _, ok in provider_calls if not ok)
+
+    def percentile(p: float) -> Optional[float]:
+        if not latencies:
+            return None
+        return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)], 3)
+
+    is_ready = warmed_up and api_connected and not saturated
+
+    return JSONResponse(
+        status_code=200 if is_ready else 503,
+        content={
+            "status": "ready" if is_ready else "not_ready",
+            "warmed_up": warmed_up,
+            "api_connected": api_connected,
+            "saturated": saturated,
+            "in_flight_pages": pages_in_flight,
+            "max_concurrent_pages": MAX_CONCURRENT_PAGES,
+            "queue_depth": pages_queued,
+            "max_queue_depth": MAX_QUEUE_DEPTH,
+            "recent_provider_calls": len(provider_calls),
+            "provider_latency_p50_seconds": percentile(0.5),
+            "provider_latency_p95_seconds": percentile(0.95),
+            "provider_error_rate": round(errors / len(provider_calls), 3) if provider_calls else None
+        }
+    )
+
+
 @app.post("/api/v1/process-invoice", response_model=InvoiceResponse)
 async def process_invoice(
-    files: List[UploadFile] = File(..., description="Upload PDF or image files")
+    files: List[UploadFile] = File(..., description="Upload PDF or image files"),
+    pages: Optional[str] = Form(
+        None,
+        description="Comma-separated page indices to process (e.g. retry_pages from a partial response)"
+    ),
+    x_request_timeout: Optional[str] = Header(
+        None,
+        description="Request deadline in seconds"
+    )
 ):
     start_time = time.time()
+    deadline = time.monotonic() + parse_request_timeout(x_request_timeout)
     
     if not files:
         raise HTTPException(400, "No files uploaded")
 
-    # Check if API is available based on mode
-    if ocr_mode == "groq" and not groq_client:
-        raise HTTPException(
-            503,
-            "Groq API not available. Set GROQ_API_KEY in .env"
-        )
-    elif ocr_mode == "gemini" and not gemini_model:
-        raise HTTPException(
-            503,
-            "Gemini API not available. Set GEMINI_API_KEY in .env"
-        )
-    elif ocr_mode not in ["groq", "gemini"]:
-        raise HTTPException(
-            503,
-            f"Invalid OCR_MODE '{ocr_mode}'. Set OCR_MODE to 'gemini' or 'groq' in .env"
-        )
+    check_provider_available()
 
     temp_files = []
-    image_paths = []
 
     try:
-        if len(files) == 1:
-            f = files[0]
+        image_paths, pdf_path = await save_uploads(files, temp_files)
+        selected = parse_page_selection(pages, len(image_paths))
 
-            with tempfile.NamedTemporaryFile(
-                delete=False,
-                suffix=Path(f.filename).suffix
-            ) as tmp:
-                tmp.write(await f.read())
-                temp_files.append(tmp.name)
+        provider = "Groq" if ocr_mode == "groq" else "Gemini"
+        print(f"Processing {len(selected if selected is not None else image_paths)} image(s) with {provider}...")
 
-            if is_pdf(f.filename):
-                print(f"Processing PDF: {f.filename}")
-                image_paths = await pdf_to_images(tmp.name)
-                temp_files.extend(image_paths)
+        results, statuses = await process_pages(image_paths, deadline, selected)
+        # Validation checks whole invoices, so page retries and partial results skip it
+        if selected is None and all(s.status == "ok" for s in statuses.values()):
+            await refine_pages(
+                image_paths, results, statuses, deadline, REEXTRACT_MAX_PAGES, pdf_path, temp_files
+            )
+        page_statuses = [statuses[i] for i in sorted(statuses)]
 
-            elif is_image(f.filename):
-                print(f"Processing image: {f.filename}")
-                image_paths = [tmp.name]
+        if not results:
+            timed_out = any(s.status in ("timeout", "skipped") for s in page_statuses)
+            raise HTTPException(
+                504 if timed_out else 500,
+                {
+                    "message": "Failed to extract data from any images. Check server logs for details.",
+                    "pages": [s.model_dump() for s in page_statuses],
+                    "retry_pages": [s.page_index for s in page_statuses if s.status != "ok"]
+                }
+            )
 
-            else:
-                raise HTTPException(
-                    400,
-                    f"Unsupported file type: {f.filename}"
-                )
+        invoice = build_invoice_response([results[i] for i in sorted(results)], page_statuses, start_time)
+        print(f"Processing complete in {invoice.processing_time_seconds}s")
+        return invoice
 
-        else:
-            print(f"Processing {len(files)} files")
-
-            for f in files:
-                if not is_image(f.filename):
-                    raise HTTPException(
-                        400,
-                        f"Multiple files must all be images. Found: {f.filename}"
-                    )
-
-                with tempfile.NamedTemporaryFile(
-                    delete=False,
-                    suffix=Path(f.filename).suffix
-                ) as tmp:
-                    tmp.write(await f.read())
-                    temp_files.append(tmp.name)
-                    image_paths.append(tmp.name)
+    except HTTPException:
+        raise
 
-        provider = "Groq" if ocr_mode == "groq" else "Gemini"
-        print(f"Processing {len(image_paths)} image(s) with {provider}...")
+    except Exception as e:
+        print(f"Error: {e}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(500, f"Processing error: {str(e)}")
 
-        results = await asyncio.gather(
-            *[process_single_image(p) for p in image_paths]
-        )
+    finally:
+        await cleanup(temp_files)
 
-        results = [r for r in results if r]
 
-        if not results:
-            raise HTTPException(
-                500,
-                "Failed to extract data from any images. Check server logs for details."
-            )
+@app.post("/api/v1/process-invoices", response_model=List[InvoiceResponse])
+async def process_invoices(
+    files: List[UploadFile] = File(..., description="Upload a PDF or images containing several invoices"),
+    stream: bool = Form(
+        False,
+        description="Stream invoices as newline-delimited JSON as soon as each one is complete"
+    ),
+    pages: Optional[str] = Form(
+        None,
+        description="Comma-separated page indices to process (e.g. retry_pages from a partial response)"
+    ),
+    x_request_timeout: Optional[str] = Header(
+        None,
+        description="Request deadline in seconds"
+    )
+):
+    start_time = time.time()
+    deadline = time.monotonic() + parse_request_timeout(
+        x_request_timeout, DEFAULT_BATCH_REQUEST_TIMEOUT, MAX_BATCH_REQUEST_TIMEOUT
+    )
 
-        print(f"Merging data from {len(results)} result(s)...")
-        merged = merge_invoice_data(results)
+    if not files:
+        raise HTTPException(400, "No files uploaded")
 
-        # Ensure currency is always a string
-        if not merged.get("currency") or not isinstance(merged.get("currency"), str):
-            merged["currency"] = "INR"
-        
-        # Convert numeric fields to proper types or None
-        for field in ["total_amount", "tax_amount", "discount_amount"]:
-            if merged.get(field) == 0.0 and len(results) == 1:
-                # For single result, use original value (might be None)
-                if results[0].get(field) is None:
-                    merged[field] = None
-        
-        # Calculate processing time
-        end_time = time.time()
-        processing_time = round(end_time - start_time, 2)
-        merged["processing_time_seconds"] = processing_time
-        
-        print(f"Processing complete in {processing_time}s")
-        return InvoiceResponse(**merged)
+    check_provider_available()
+
+    temp_files = []
+
+    try:
+        image_paths, pdf_path = await save_uploads(files, temp_files)
+        selected = parse_page_selection(pages, len(image_paths))
+
+        provider = "Groq" if ocr_mode == "groq" else "Gemini"
+        page_count = len(selected if selected is not None else image_paths)
+        print(f"Splitting {page_count} page(s) into invoices with {provider}...")
+
+        if stream:
+            # The stream outlives this handler, so it takes over temp file cleanup
+            stream_files = temp_files
+            temp_files = []
+
+            async def ndjson():
+                try:
+                    async for invoice in iter_invoices(
+                        image_paths, deadline, start_time, pdf_path, stream_files, selected
+                    ):
+                        yield invoice.model_dump_json() + "\n"
+                finally:
+                    await cleanup(stream_files)
+
+            return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+        invoices = [
+            invoice async for invoice in iter_invoices(
+                image_paths, deadline, start_time, pdf_path, temp_files, selected
+            )
+        ]
+        print(f"Split into {len(invoices)} invoice(s) in {round(time.time() - start_time, 2)}s")
+        return invoices
 
     except HTTPException:
         raise
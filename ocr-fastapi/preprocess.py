@@ -0,0 +1,197 @@
+"""
+Page cleanup for the preprocessing worker pool: auto-rotate, deskew, crop margins,
+optionally binarize. Kept apart from main so spawned workers only import NumPy and PIL.
+"""
+
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+PREPROCESS_BINARIZE = os.getenv("PREPROCESS_BINARIZE", "false").lower() == "true"
+PREPROCESS_MAX_SKEW = float(os.getenv("PREPROCESS_MAX_SKEW_DEGREES", "10"))
+PREPROCESS_CROP_PADDING = float(os.getenv("PREPROCESS_CROP_PADDING", "0.02"))
+PREPROCESS_ANALYSIS_SIZE = 1000  # Longest side of the downscaled copy used for estimates
+
+
+def start_worker() -> int:
+    """No-op task used to spawn the workers ahead of the first page"""
+    return os.getpid()
+
+
+def otsu_threshold(gray: "np.ndarray") -> int:
+    """Grey level that best separates ink from paper (Otsu's method)"""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    p = hist / hist.sum()
+    omega = np.cumsum(p)
+    mu = np.cumsum(p * np.arange(256))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (mu[-1] * omega - mu) ** 2 / (omega * (1 - omega))
+    return int(np.argmax(np.nan_to_num(between)))
+
+
+def analysis_view(img: Image.Image) -> "np.ndarray":
+    """Downscaled greyscale copy used for orientation, skew and crop estimates"""
+    small = img.convert("L")
+    small.thumbnail((PREPROCESS_ANALYSIS_SIZE, PREPROCESS_ANALYSIS_SIZE))
+    return np.asarray(small)
+
+
+def estimate_skew(ink: "np.ndarray", max_angle: float, step: float = 0.25) -> Tuple[float, float]:
+    """
+    Projection-profile skew estimate: rotate ink coordinates by every candidate angle
+    at once and keep the angle whose row histogram is sharpest.
+    Returns degrees to pass to Image.rotate and the sharpness score for that angle.
+    """
+    ys, xs = np.nonzero(ink)
+    if len(ys) < 100:
+        return 0.0, 0.0
+    if len(ys) > 50000:
+        keep = np.random.default_rng(0).choice(len(ys), 50000, replace=False)
+        ys, xs = ys[keep], xs[keep]
+
+    angles = np.deg2rad(np.arange(-max_angle, max_angle + step / 2, step))
+    rows = np.outer(np.cos(angles), ys) - np.outer(np.sin(angles), xs)
+    rows = np.rint(rows - rows.min()).astype(np.int64)
+    bins = int(rows.max()) + 1
+    hist = np.bincount(
+        (rows + (np.arange(len(angles)) * bins)[:, None]).ravel(),
+        minlength=len(angles) * bins
+    ).reshape(len(angles), bins)
+    scores = (hist.astype(np.float64) ** 2).sum(axis=1)
+    best = int(np.argmax(scores))
+    return float(np.rad2deg(angles[best])), float(scores[best])
+
+
+def line_end_raggedness(ink: "np.ndarray") -> float:
+    """
+    How much more the right ends of text rows vary than their left starts, as a fraction
+    of the width. Positive for left-aligned text that is upright, negative when upside down.
+    """
+    rows = ink[ink.mean(axis=1) > 0.01]
+    if len(rows) < 10:
+        return 0.0
+
+    w = rows.shape[1]
+    starts = rows.argmax(axis=1)
+    ends = w - 1 - rows[:, ::-1].argmax(axis=1)
+    return float((ends.std() - starts.std()) / w)
+
+
+def content_bbox(ink: "np.ndarray", padding: float) -> Optional[Tuple[float, float, float, float]]:
+    """Bounding box of the ink as fractions of the page (left, top, right, bottom), with padding"""
+    # Ignore rows/columns with only specks of noise
+    rows = np.flatnonzero(ink.mean(axis=1) > 0.002)
+    cols = np.flatnonzero(ink.mean(axis=0) > 0.002)
+    if not len(rows) or not len(cols):
+        return None
+
+    h, w = ink.shape
+    return (
+        max(cols[0] / w - padding, 0.0),
+        max(rows[0] / h - padding, 0.0),
+        min((cols[-1] + 1) / w + padding, 1.0),
+        min((rows[-1] + 1) / h + padding, 1.0)
+    )
+
+
+def clean_page_image(image_path: str) -> Dict[str, Any]:
+    """
+    Turn sideways pages upright, deskew, crop to the content and optionally binarize.
+    Runs in the preprocessing worker pool; writes the cleaned page next to the original
+    and returns its path plus what was done.
+    """
+    started = time.perf_counter()
+    original = Image.open(image_path)
+    rotated = {3: 180, 6: 270, 8: 90}.get(original.getexif().get(0x0112, 1), 0)
+    img = ImageOps.exif_transpose(original).convert("RGB")
+    skew = 0.0
+    cropped = False
+    orientation_uncertain = False
+
+    gray = analysis_view(img)
+    ink = gray <= otsu_threshold(gray)
+
+    # Mostly dark pages (inverted scans, photos dominated by background) only get EXIF rotation
+    if 0 < ink.mean() < 0.5:
+        # Text lines give a much sharper row profile than column profile, so compare
+        # the best skew estimate as-is against the one for the page turned sideways
+        skew, upright_score = estimate_skew(ink, PREPROCESS_MAX_SKEW)
+        sideways_skew, sideways_score = estimate_skew(np.rot90(ink), PREPROCESS_MAX_SKEW)
+
+        if sideways_score > 1.1 * upright_score:
+            # The profile can't tell 90 from 270 degrees: straighten the page turned 90,
+            # then put the aligned line starts on the left. Leave the page alone if unclear.
+            turned = img.rotate(90, expand=True)
+            if abs(sideways_skew) >= 0.25:
+                turned = turned.rotate(sideways_skew, resample=Image.BICUBIC, expand=True, fillcolor="white")
+            turned_gray = analysis_view(turned)
+            turned_ink = turned_gray <= otsu_threshold(turned_gray)
+            raggedness = line_end_raggedness(turned_ink)
+
+            if abs(raggedness) < 0.02:
+                orientation_uncertain = True
+                skew = 0.0
+            else:
+                turn = 90
+                if raggedness < 0:
+                    turned = turned.rotate(180)
+                    turned_ink = np.rot90(turned_ink, 2)
+                    turn = 270
+                img, ink = turned, turned_ink
+                rotated = (rotated + turn) % 360
+                skew = round(sideways_skew, 2)
+        else:
+            skew = round(skew, 2)
+            if abs(skew) >= 0.25:
+                img = img.rotate(skew, resample=Image.BICUBIC, expand=True, fillcolor="white")
+                gray = analysis_view(img)
+                ink = gray <= otsu_threshold(gray)
+
+        box = content_bbox(ink, PREPROCESS_CROP_PADDING)
+        if box and (box[2] - box[0]) * (box[3] - box[1]) < 0.95:
+            w, h = img.size
+            img = img.crop((int(box[0] * w), int(box[1] * h), int(box[2] * w), int(box[3] * h)))
+            cropped = True
+
+    stem = os.path.splitext(image_path)[0]
+    binarized = PREPROCESS_BINARIZE
+    if binarized:
+        full = np.asarray(img.convert("L"))
+        img = Image.fromarray(full > otsu_threshold(full))
+        out_path = f"{stem}_clean.png"
+        img.save(out_path, "PNG", optimize=True)
+    else:
+        out_path = f"{stem}_clean.jpg"
+        # Re-encode with the input's quantization tables, so cleanup doesn't inflate JPEG pages
+        quantization = getattr(original, "quantization", None) or {}
+        qtables = [quantization[k] for k in sorted(quantization)]
+        if original.format == "JPEG" and qtables:
+            img.save(out_path, "JPEG", qtables=qtables if len(qtables) > 1 else qtables * 2)
+        else:
+            img.save(out_path, "JPEG")
+
+    input_bytes = os.path.getsize(image_path)
+    output_bytes = os.path.getsize(out_path)
+
+    # Not smaller and the orientation didn't change: send the original
+    if output_bytes >= input_bytes and not (rotated or skew):
+        os.remove(out_path)
+        out_path = image_path
+        output_bytes = input_bytes
+        cropped = False
+        binarized = False
+
+    return {
+        "path": out_path,
+        "seconds": round(time.perf_counter() - started, 3),
+        "rotated_degrees": rotated,
+        "skew_degrees": skew,
+        "cropped": cropped,
+        "binarized": binarized,
+        "orientation_uncertain": orientation_uncertain,
+        "input_bytes": input_bytes,
+        "output_bytes": output_bytes
+    }
@@ -0,0 +1,42 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def upload_pages(count: int):
+    """Image uploads for a TestClient request; page i contains b"page <i>" """
+    return [("files", (f"page_{i}.jpg", f"page {i}".encode(), "image/jpeg")) for i in range(count)]
+
+
+class FakeProvider:
+    """Answers from `pages[i]` after `delays[i]` seconds for pages made with upload_pages"""
+
+    def __init__(self):
+        self.pages = {}
+        self.delays = {}
+        self.calls = []
+
+    async def __call__(self, image_path, timeout=None, provider=None, hint=None):
+        i = int(Path(image_path).read_bytes().split()[-1])
+        self.calls.append(i)
+        await asyncio.sleep(self.delays.get(i, 0))
+        return dict(self.pages.get(i) or {})
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    fake = FakeProvider()
+    monkeypatch.setattr(main, "process_single_image", fake)
+    monkeypatch.setattr(main, "ocr_mode", "groq")
+    monkeypatch.setattr(main, "groq_client", object())
+    # Each TestClient runs its own event loop
+    monkeypatch.setattr(main, "page_semaphore", asyncio.Semaphore(main.MAX_CONCURRENT_PAGES))
+    monkeypatch.setattr(main, "reextract_semaphore", asyncio.Semaphore(main.REEXTRACT_CONCURRENCY))
+    return fake
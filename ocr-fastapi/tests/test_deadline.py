@@ -0,0 +1,130 @@
+"""
+Tests for request deadlines, partial results and page retries
+"""
+
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import main
+from conftest import upload_pages
+
+
+def page(invoice_number="INV-1", total=10):
+    return {"invoice_number": invoice_number, "invoice_date": "2024-01-01", "total_amount": total}
+
+
+def post(files, timeout=None, **data):
+    headers = {"X-Request-Timeout": timeout} if timeout is not None else {}
+    return TestClient(main.app).post("/api/v1/process-invoice", files=files, data=data, headers=headers)
+
+
+@pytest.mark.parametrize("value", ["nan", "inf", "-inf", "0", "-1", "soon"])
+def test_invalid_request_timeout_is_rejected(value):
+    with pytest.raises(HTTPException) as error:
+        main.parse_request_timeout(value)
+    assert error.value.status_code == 400
+
+
+def test_request_timeout_defaults_and_is_capped():
+    assert main.parse_request_timeout(None) == main.DEFAULT_REQUEST_TIMEOUT
+    assert main.parse_request_timeout("1e9") == main.MAX_REQUEST_TIMEOUT
+    assert main.parse_request_timeout("2.5") == 2.5
+
+
+def test_nan_request_timeout_returns_400(provider):
+    response = post(upload_pages(1), timeout="nan")
+
+    assert response.status_code == 400
+    assert provider.calls == []
+
+
+def test_slow_page_times_out_and_is_listed_for_retry(provider):
+    provider.pages = {0: page(), 1: page(), 2: page()}
+    provider.delays = {1: 1}
+
+    response = post(upload_pages(3), timeout="0.3")
+    body = response.json()
+
+    assert response.status_code == 200
+    assert body["partial"]
+    assert body["retry_pages"] == [1]
+    assert [p["status"] for p in body["pages"]] == ["ok", "timeout", "ok"]
+
+
+def test_pages_not_sent_before_the_deadline_are_skipped(provider, monkeypatch):
+    monkeypatch.setattr(main, "MAX_PAGES_PER_REQUEST", 1)
+    provider.pages = {0: page(), 1: page(), 2: page(), 3: page()}
+    provider.delays = {1: 1}
+
+    body = post(upload_pages(4), timeout="0.3").json()
+
+    assert [p["status"] for p in body["pages"]] == ["ok", "timeout", "skipped", "skipped"]
+    assert body["retry_pages"] == [1, 2, 3]
+    assert provider.calls == [0, 1]
+
+
+def test_pages_waiting_for_a_provider_slot_at_the_deadline_are_skipped(provider, monkeypatch):
+    # Other requests hold every slot but one
+    monkeypatch.setattr(main, "page_semaphore", asyncio.Semaphore(1))
+    provider.delays = {0: 1}
+
+    response = post(upload_pages(3), timeout="0.3")
+    detail = response.json()["detail"]
+
+    assert response.status_code == 504
+    assert [p["status"] for p in detail["pages"]] == ["timeout", "skipped", "skipped"]
+    assert provider.calls == [0]
+
+
+def test_page_without_budget_left_is_not_sent(provider, monkeypatch):
+    monkeypatch.setattr(main, "provider_calls", main.deque(maxlen=10))
+    sent = []
+
+    async def run():
+        return await main.process_page("page_0.jpg", time.monotonic() - 1, on_send=lambda: sent.append(1))
+
+    assert asyncio.run(run()) == ({}, 0.0)
+    assert provider.calls == [] and sent == []
+    # Not counted as a provider error in /ready
+    assert len(main.provider_calls) == 0
+    assert not main.page_semaphore.locked()
+
+
+def test_no_page_in_time_returns_504_with_page_statuses(provider):
+    provider.delays = {0: 1, 1: 1}
+
+    response = post(upload_pages(2), timeout="0.3")
+    detail = response.json()["detail"]
+
+    assert response.status_code == 504
+    assert [p["status"] for p in detail["pages"]] == ["timeout", "timeout"]
+    assert detail["retry_pages"] == [0, 1]
+
+
+def test_failed_pages_return_500(provider):
+    response = post(upload_pages(2))
+
+    assert response.status_code == 500
+    assert response.json()["detail"]["retry_pages"] == [0, 1]
+
+
+def test_retry_processes_only_selected_pages(provider):
+    provider.pages = {0: page(), 1: page(), 2: page(total=5)}
+
+    body = post(upload_pages(3), pages="2, 0").json()
+
+    assert sorted(provider.calls) == [0, 2]
+    assert [p["page_index"] for p in body["pages"]] == [0, 2]
+    assert body["total_amount"] == 15
+    assert not body["partial"]
+
+
+def test_invalid_page_selection_returns_400(provider):
+    response = post(upload_pages(2), pages="0,2")
+
+    assert response.status_code == 400
+    assert provider.calls == []
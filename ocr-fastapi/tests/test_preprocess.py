@@ -0,0 +1,68 @@
+"""
+Tests for page cleanup before extraction
+"""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from PIL import Image, ImageDraw
+
+import preprocess
+
+
+def text_page(ragged: bool = True) -> Image.Image:
+    """Left-aligned blocks of 'words' on an A4 page at 300 DPI"""
+    rng = np.random.default_rng(1)
+    img = Image.new("RGB", (2480, 3508), "white")
+    draw = ImageDraw.Draw(img)
+
+    for row in range(35):
+        y = 800 + row * 55
+        x = 600
+        end = int(rng.integers(1300, 1900)) if ragged else 1900
+        while x < end:
+            for _ in range(int(rng.integers(3, 10))):
+                width = int(rng.integers(10, 22))
+                draw.rectangle([x, y + int(rng.integers(0, 8)), x + width, y + 28], fill="black")
+                x += width + 4
+            x += 22
+    return img
+
+
+def clean(tmp_path, img: Image.Image, name: str):
+    path = str(tmp_path / f"{name}.jpg")
+    img.save(path, "JPEG")
+    info = preprocess.clean_page_image(path)
+
+    gray = preprocess.analysis_view(Image.open(info["path"]))
+    ink = gray <= preprocess.otsu_threshold(gray)
+    return info, ink
+
+
+@pytest.mark.parametrize("angle", [90, 270, -88, 5, 0])
+def test_pages_come_out_upright(tmp_path, angle):
+    page = text_page().rotate(angle, expand=True, fillcolor="white", resample=Image.BICUBIC)
+    info, ink = clean(tmp_path, page, f"page_{angle}")
+
+    assert not info["orientation_uncertain"]
+    assert preprocess.estimate_skew(ink, 10)[0] == 0.0
+    # Line starts aligned on the left means the text is not upside down
+    assert preprocess.line_end_raggedness(ink) > 0.05
+    assert info["cropped"]
+
+
+def test_sideways_page_without_direction_cue_is_left_alone(tmp_path):
+    page = text_page(ragged=False).rotate(90, expand=True)
+    info, _ = clean(tmp_path, page, "justified")
+
+    assert info["orientation_uncertain"]
+    assert info["rotated_degrees"] == 0
+
+
+def test_cleaned_page_is_not_larger_than_input(tmp_path):
+    # PIL's default JPEG quality, as used when rasterizing PDFs
+    info, _ = clean(tmp_path, text_page(), "upright")
+
+    assert info["cropped"]
+    assert info["output_bytes"] < info["input_bytes"]
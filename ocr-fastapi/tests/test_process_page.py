@@ -0,0 +1,68 @@
+"""
+Tests for page dispatch and the provider call accounting behind /ready
+"""
+
+import asyncio
+import time
+
+import main
+
+
+def test_abandoned_call_holds_its_slot_until_it_returns(monkeypatch):
+    release = None
+
+    async def slow_provider(image_path, timeout=None, provider=None, hint=None):
+        # Stands in for a provider thread that ignores cancellation
+        await release.wait()
+        return {"invoice_number": "A"}
+
+    monkeypatch.setattr(main, "process_single_image", slow_provider)
+    monkeypatch.setattr(main, "provider_calls", main.deque(maxlen=10))
+
+    async def run():
+        nonlocal release
+        release = asyncio.Event()
+        semaphore = asyncio.Semaphore(1)
+        monkeypatch.setattr(main, "page_semaphore", semaphore)
+
+        page = asyncio.create_task(main.process_page("page_0.jpg", time.monotonic() + 10))
+        await asyncio.sleep(0.05)
+        page.cancel()
+        await asyncio.gather(page, return_exceptions=True)
+
+        # The request gave up, but the call is still running
+        assert main.pages_in_flight == 1
+        assert semaphore.locked()
+        assert len(main.provider_calls) == 0
+
+        await asyncio.sleep(0.1)
+        release.set()
+        await asyncio.sleep(0.05)
+
+        assert main.pages_in_flight == 0
+        assert not semaphore.locked()
+        assert not main.abandoned_calls
+        latency, ok = main.provider_calls[0]
+        # Recorded when the call finished, not when the request gave up
+        assert ok and latency >= 0.15
+
+    asyncio.run(run())
+
+
+def test_reextraction_does_not_wait_for_first_pass_slots(monkeypatch):
+    async def fake_provider(image_path, timeout=None, provider=None, hint=None):
+        return {"invoice_number": "A"}
+
+    monkeypatch.setattr(main, "process_single_image", fake_provider)
+
+    async def run():
+        # Every first-pass slot is taken by other pages of the batch
+        monkeypatch.setattr(main, "page_semaphore", asyncio.Semaphore(0))
+        deadline = time.monotonic() + 10
+        return await asyncio.wait_for(
+            main.process_page("page_0.jpg", deadline, reextract=True), timeout=1
+        )
+
+    result, _ = asyncio.run(run())
+    assert result == {"invoice_number": "A"}
+
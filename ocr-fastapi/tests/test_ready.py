@@ -0,0 +1,111 @@
+"""
+Tests for connection warm-up and /ready, against a local stand-in for the provider
+"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def stand_in():
+    """Local HTTP server that keeps connections open; records the client port of each request"""
+    ports = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            ports.append(self.client_address[1])
+            # Keep the warm-up requests overlapping, so each one opens its own connection
+            time.sleep(0.2)
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/openai/v1", ports
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def service(monkeypatch):
+    """Run the real lifespan with page cleanup and tracing off"""
+    for name in ["ocr_mode", "fallback_mode", "warmed_up", "groq_client", "gemini_model", "http_client"]:
+        monkeypatch.setattr(main, name, getattr(main, name))
+    monkeypatch.setattr(main, "PREPROCESS_ENABLED", False)
+    monkeypatch.setattr(main, "TRACING_ENABLED", False)
+    monkeypatch.setattr(main, "WARMUP_CONNECTIONS", 3)
+    monkeypatch.setattr(main, "provider_calls", main.deque(maxlen=10))
+    monkeypatch.delenv("FALLBACK_OCR_MODE", raising=False)
+    return monkeypatch
+
+
+def test_groq_warm_up_fills_the_pool_and_ready_reports_it(service, stand_in):
+    base_url, ports = stand_in
+    service.setenv("OCR_MODE", "groq")
+    service.setenv("GROQ_API_KEY", "test-key")
+    service.setenv("PROVIDER_BASE_URL", base_url)
+
+    with TestClient(main.app) as client:
+        # Three warm-up requests over three connections, all idle in the shared pool
+        assert len(set(ports)) == 3
+        pool = main.http_client._transport._pool
+        assert len(pool.connections) == 3
+        assert all(c.is_idle() for c in pool.connections)
+        assert str(main.groq_client.base_url).rstrip("/") == base_url
+
+        response = client.get("/ready")
+        body = response.json()
+
+        assert response.status_code == 200
+        assert body["warmed_up"] and body["api_connected"]
+        assert body["in_flight_pages"] == 0 and body["queue_depth"] == 0
+        assert body["recent_provider_calls"] == 0 and body["provider_error_rate"] is None
+
+        main.provider_calls.extend([(0.5, True), (1.5, False)])
+        service.setattr(main, "pages_queued", main.MAX_QUEUE_DEPTH)
+        response = client.get("/ready")
+        body = response.json()
+
+        assert response.status_code == 503
+        assert body["saturated"]
+        assert body["provider_error_rate"] == 0.5
+        assert body["provider_latency_p50_seconds"] == 1.5
+
+
+def test_gemini_mode_skips_warm_up(service, stand_in):
+    base_url, ports = stand_in
+    service.setenv("OCR_MODE", "gemini")
+    service.setenv("GEMINI_API_KEY", "test-key")
+    service.setenv("PROVIDER_BASE_URL", base_url)
+
+    with TestClient(main.app) as client:
+        response = client.get("/ready")
+
+    assert ports == []
+    assert response.status_code == 200
+    assert response.json()["api_connected"]
+
+
+def test_not_ready_without_provider(service, stand_in):
+    _, ports = stand_in
+    service.setenv("OCR_MODE", "groq")
+    service.delenv("GROQ_API_KEY", raising=False)
+
+    with TestClient(main.app) as client:
+        response = client.get("/ready")
+
+    assert response.status_code == 503
+    assert not response.json()["api_connected"]
+    assert ports == []
@@ -0,0 +1,129 @@
+"""
+Tests for splitting multi-invoice documents
+"""
+
+import asyncio
+import time
+
+from fastapi.testclient import TestClient
+
+import main
+from conftest import upload_pages
+
+
+def page(invoice_number, page_number=None, total_pages=None, total=None):
+    return {
+        "invoice_number": invoice_number,
+        "invoice_date": "2024-01-01",
+        "page_number": page_number,
+        "total_pages": total_pages,
+        "total_amount": total,
+        "line_items": []
+    }
+
+
+def test_split_by_invoice_number():
+    pages = [page("A", 1, 2), page("A", 2, 2, 100), page("B", total=50), page("C", total=20)]
+    assert main.split_invoice_pages(pages) == [[0, 1], [2], [3]]
+
+
+def test_split_by_page_labels_and_failed_pages():
+    pages = [
+        {"customer_name": "Acme", "page_number": 1, "total_pages": 2},
+        {"page_number": 2, "total_pages": 2},
+        {},
+        {"customer_name": "Beta Traders"},
+        {"line_items": [{"item_name": "x"}]}
+    ]
+    assert main.split_invoice_pages(pages) == [[0, 1, 2], [3, 4]]
+
+
+def run_iter_invoices(monkeypatch, pages):
+    image_paths = [f"page_{i}.jpg" for i in range(len(pages))]
+    by_path = dict(zip(image_paths, pages))
+
+    async def fake_provider(image_path, timeout=None, provider=None, hint=None):
+        return dict(by_path[image_path])
+
+    monkeypatch.setattr(main, "process_single_image", fake_provider)
+    monkeypatch.setattr(main, "REEXTRACT_MAX_PAGES", 0)
+
+    async def collect():
+        deadline = time.monotonic() + 10
+        return [
+            invoice async for invoice in main.iter_invoices(image_paths, deadline, time.time())
+        ]
+
+    return asyncio.run(collect())
+
+
+def test_iter_invoices_emits_several_invoices_at_once(monkeypatch):
+    invoices = run_iter_invoices(monkeypatch, [
+        page("A", 1, 2),
+        page("A", 2, 2, 100),
+        page("B", total=50),
+        page("C", total=20)
+    ])
+
+    assert [inv.invoice_number for inv in invoices] == ["A", "B", "C"]
+    assert [[p.page_index for p in inv.pages] for inv in invoices] == [[0, 1], [2], [3]]
+    assert [inv.total_amount for inv in invoices] == [100, 50, 20]
+
+
+def test_iter_invoices_two_invoices(monkeypatch):
+    invoices = run_iter_invoices(monkeypatch, [
+        page("A", 1, 2, 10),
+        page("A", 2, 2, 30),
+        page("B", total=5)
+    ])
+
+    assert [inv.invoice_number for inv in invoices] == ["A", "B"]
+    assert [inv.total_amount for inv in invoices] == [40, 5]
+    assert not any(inv.partial for inv in invoices)
+
+
+def post_batch(files, timeout=None, **data):
+    headers = {"X-Request-Timeout": timeout} if timeout is not None else {}
+    response = TestClient(main.app).post("/api/v1/process-invoices", files=files, data=data, headers=headers)
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_pages_after_the_deadline_are_not_attached_to_the_last_invoice(provider):
+    provider.pages = {0: page("A", total=10), 1: page("B", total=20), 2: page("B"), 3: page("C")}
+    provider.delays = {2: 1, 3: 1}
+
+    invoices = post_batch(upload_pages(4), timeout="0.3")
+
+    assert [inv["invoice_number"] for inv in invoices] == ["A", "B", None]
+    assert [[p["page_index"] for p in inv["pages"]] for inv in invoices] == [[0], [1], [2, 3]]
+    assert not invoices[1]["partial"]
+    assert invoices[2]["retry_pages"] == [2, 3]
+    assert [p["status"] for p in invoices[2]["pages"]] == ["timeout", "timeout"]
+
+
+def test_failed_last_page_is_reported_on_its_own(provider, monkeypatch):
+    monkeypatch.setattr(main, "REEXTRACT_MAX_PAGES", 0)
+    provider.pages = {0: page("A", total=10)}
+
+    invoices = post_batch(upload_pages(2))
+
+    assert [[p["page_index"] for p in inv["pages"]] for inv in invoices] == [[0], [1]]
+    assert not invoices[0]["partial"]
+    assert invoices[1]["retry_pages"] == [1]
+
+
+def test_batch_retry_splits_only_selected_pages(provider):
+    provider.pages = {
+        0: page("A", 1, 2),
+        1: page("A", 2, 2, 100),
+        2: page("B", total=50),
+        3: page("C", total=20)
+    }
+
+    invoices = post_batch(upload_pages(4), pages="1,2")
+
+    assert sorted(provider.calls) == [1, 2]
+    assert [inv["invoice_number"] for inv in invoices] == ["A", "B"]
+    assert [[p["page_index"] for p in inv["pages"]] for inv in invoices] == [[1], [2]]
+    assert all(p["reextractions"] == 0 for inv in invoices for p in inv["pages"])
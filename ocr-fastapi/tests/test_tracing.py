@@ -0,0 +1,127 @@
+"""
+Tests for trace IDs and on-demand profiling
+"""
+
+import time
+from contextlib import contextmanager
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from conftest import upload_pages
+
+
+class FakeProfiler:
+    instances = []
+
+    def __init__(self, async_mode=None):
+        self.started = self.stopped = None
+        FakeProfiler.instances.append(self)
+
+    @property
+    def is_running(self):
+        return self.started is not None and self.stopped is None
+
+    def start(self):
+        self.started = time.monotonic()
+
+    def stop(self):
+        self.stopped = time.monotonic()
+
+    def output_html(self):
+        return "<html></html>"
+
+
+class FakeSpan:
+    def __init__(self):
+        self.ended = None
+
+    def get_span_context(self):
+        class Context:
+            trace_id = 0xabc
+        return Context()
+
+    def set_attribute(self, key, value):
+        pass
+
+    def is_recording(self):
+        return self.ended is None
+
+    def end(self):
+        self.ended = time.monotonic()
+
+
+class FakeTracer:
+    def __init__(self):
+        self.spans = {}
+
+    @contextmanager
+    def start_as_current_span(self, name, attributes=None, end_on_exit=True):
+        current = FakeSpan()
+        self.spans.setdefault(name, current)
+        yield current
+        if end_on_exit:
+            current.end()
+
+
+@pytest.fixture
+def profiling(monkeypatch, tmp_path):
+    FakeProfiler.instances = []
+    monkeypatch.setattr(main, "Profiler", FakeProfiler, raising=False)
+    monkeypatch.setattr(main, "PROFILING_SUPPORT", True)
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(main, "PROFILE_DIR", str(tmp_path))
+
+
+def test_every_response_has_a_trace_id():
+    response = TestClient(main.app).get("/health")
+
+    assert response.status_code == 200
+    assert len(response.headers["X-Trace-Id"]) == 32
+
+
+@pytest.mark.parametrize("headers", [{"X-Profile": "1"}, {"X-Profile": "1", "X-Admin-Token": "wrong"}])
+def test_profiling_requires_admin_token(profiling, headers):
+    response = TestClient(main.app).get("/health", headers=headers)
+
+    assert response.status_code == 403
+    assert FakeProfiler.instances == []
+
+
+def test_profiling_is_refused_when_admin_token_unset(profiling, monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", None)
+    response = TestClient(main.app).get("/health", headers={"X-Profile": "1", "X-Admin-Token": ""})
+
+    assert response.status_code == 403
+
+
+def test_profiling_without_pyinstrument_returns_503(profiling, monkeypatch):
+    monkeypatch.setattr(main, "PROFILING_SUPPORT", False)
+    response = TestClient(main.app).get("/health", headers={"X-Profile": "1", "X-Admin-Token": "secret"})
+
+    assert response.status_code == 503
+
+
+def test_streamed_batch_is_profiled_and_traced_to_the_end(profiling, provider, monkeypatch):
+    tracer = FakeTracer()
+    monkeypatch.setattr(main, "tracer", tracer)
+    monkeypatch.setattr(main, "REEXTRACT_MAX_PAGES", 0)
+    provider.pages = {i: {"invoice_number": f"INV-{i}", "total_amount": 1} for i in range(3)}
+    provider.delays = {2: 0.3}
+
+    response = TestClient(main.app).post(
+        "/api/v1/process-invoices",
+        files=upload_pages(3),
+        data={"stream": "true"},
+        headers={"X-Profile": "1", "X-Admin-Token": "secret"}
+    )
+
+    assert len(response.text.splitlines()) == 3
+    profiler = FakeProfiler.instances[0]
+    request_span = tracer.spans["http_request"]
+    # Both cover the slow page, not just the time until the headers were sent
+    assert profiler.stopped - profiler.started >= 0.3
+    assert request_span.ended >= profiler.stopped
+    with open(response.headers["X-Profile-Path"], encoding="utf-8") as f:
+        assert f.read() == "<html></html>"
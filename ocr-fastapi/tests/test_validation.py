@@ -0,0 +1,87 @@
+"""
+Tests for local invoice validation
+"""
+
+import main
+
+
+def invoice(total, items, **fields):
+    return {
+        "invoice_number": "INV-1",
+        "invoice_date": "2024-01-01",
+        "total_amount": total,
+        "line_items": items,
+        **fields
+    }
+
+
+def item(quantity, price, total, tax=None):
+    return {
+        "item_name": "Widget",
+        "item_quantity": quantity,
+        "item_price": price,
+        "item_tax_percentage": tax,
+        "item_total": total
+    }
+
+
+def test_valid_invoice_has_no_issues():
+    assert main.validate_invoice({0: invoice(118, [item(2, 50, 100)], tax_amount=18)}) == {}
+
+
+def test_per_line_tax_counts_towards_total():
+    assert main.validate_invoice({0: invoice(118, [item(1, 100, 100, tax=18)])}) == {}
+
+
+def test_mismatched_total_flags_pages_with_items_or_totals():
+    issues = main.validate_invoice({
+        0: invoice(150, [item(2, 50, 100)]),
+        1: {"line_items": [item(1, 10, 10)]},
+        2: {}
+    })
+
+    assert sorted(issues) == [0, 1]
+    assert "Line items add up to 110" in issues[1][0]
+
+
+def test_missing_required_field_is_reported_on_first_page():
+    issues = main.validate_invoice({0: invoice(100, [item(1, 100, 100)], invoice_date=None)})
+
+    assert issues == {0: ["Missing required field(s): invoice_date"]}
+
+
+def test_line_item_arithmetic():
+    issues = main.validate_invoice({0: invoice(90, [item(2, 50, 90)])})
+
+    assert any("does not match item_total" in issue for issue in issues[0])
+
+
+def test_page_retry_is_not_validated_as_a_whole_invoice(provider):
+    from fastapi.testclient import TestClient
+    from conftest import upload_pages
+
+    # Page 1 of a valid two-page invoice: no header fields, total on the other page
+    provider.pages = {
+        0: invoice(None, [item(1, 100, 100)]),
+        1: {"line_items": [item(1, 18, 18)], "total_amount": 118}
+    }
+    response = TestClient(main.app).post(
+        "/api/v1/process-invoice", files=upload_pages(2), data={"pages": "1"}
+    )
+
+    assert response.status_code == 200
+    assert provider.calls == [1]
+    assert response.json()["pages"][0]["reextractions"] == 0
+    assert response.json()["pages"][0]["issues"] == []
+
+
+def test_invoice_with_a_failed_page_is_not_validated(provider):
+    from fastapi.testclient import TestClient
+    from conftest import upload_pages
+
+    provider.pages = {0: invoice(500, [item(1, 100, 100)])}
+    response = TestClient(main.app).post("/api/v1/process-invoice", files=upload_pages(2))
+
+    assert response.status_code == 200
+    assert provider.calls == [0, 1]
+    assert response.json()["retry_pages"] == [1]